@@ -1,16 +1,34 @@
 from __future__ import annotations
-from typing import NamedTuple
+import io
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, NamedTuple
 
 import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+
+# 大きいオブジェクトは 16 MB ごとの Range GET に分けて並列に取得する
+# 同時に保持するのは MAX_RANGE_REQUESTS 個分までに抑える (Lambda のメモリは 256 MB)
+RANGE_SIZE = 16 * 1024 * 1024
+MAX_RANGE_REQUESTS = 4
+
+
+# コンテナ再利用時も認証情報やエンドポイントの解決をやり直さないよう Session を使い回す
+_SESSION_CACHE: dict[str | None, boto3.Session] = {}
 
 
 class AwsResource:
     def __init__(self, profile: str = None):
-        if profile is not None:
-            self.session = boto3.Session(
-                profile_name=profile, region_name="ap-northeast-1")
-        else:
-            self.session = boto3.Session()
+        if profile not in _SESSION_CACHE:
+            if profile is not None:
+                _SESSION_CACHE[profile] = boto3.Session(
+                    profile_name=profile, region_name="ap-northeast-1")
+            else:
+                _SESSION_CACHE[profile] = boto3.Session()
+        self.session = _SESSION_CACHE[profile]
 
 
 class Sns(AwsResource):
@@ -38,12 +56,95 @@ class S3(AwsResource):
             Key=file_path,
         )
 
-    def read_file(self, bucket: str, key: str) -> list[str]:
+    def read_file(self, bucket: str, key: str) -> IO[bytes]:
+        # 先頭の RANGE_SIZE 分を取得し、ContentRange から全体のサイズを得る
+        try:
+            res = self.client.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f"bytes=0-{RANGE_SIZE - 1}",
+            )
+        except ClientError as e:
+            # 空のオブジェクトは Range 指定で取得できない
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            return self.client.get_object(Bucket=bucket, Key=key)["Body"]
+        size = int(res["ContentRange"].rsplit("/", 1)[-1])
+        if size <= RANGE_SIZE:
+            return res["Body"]
+        return io.BufferedReader(RangeReader(
+            client=self.client,
+            bucket=bucket,
+            key=key,
+            etag=res["ETag"],
+            size=size,
+            first=res["Body"],
+        ), buffer_size=RANGE_SIZE)
+
+
+class RangeReader(io.RawIOBase):
+    # first (先頭の RANGE_SIZE 分) を読む間に以降の Range GET を先読みし、先頭から順にバイト列を返す
+    def __init__(self, client, bucket: str, key: str, etag: str, size: int, first: IO[bytes]):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.size = size
+        self.first = first
+        self.executor = ThreadPoolExecutor(max_workers=MAX_RANGE_REQUESTS)
+        self.starts = iter(range(RANGE_SIZE, size, RANGE_SIZE))
+        self.pending: deque[Future[bytes]] = deque()
+        self.buffer = memoryview(b"")
+        for _ in range(MAX_RANGE_REQUESTS):
+            self.__submit()
+
+    def __submit(self) -> None:
+        start = next(self.starts, None)
+        if start is not None:
+            end = min(start + RANGE_SIZE, self.size) - 1
+            self.pending.append(self.executor.submit(self.__fetch, start, end))
+
+    def __fetch(self, start: int, end: int) -> bytes:
         res = self.client.get_object(
-            Bucket=bucket,
-            Key=key
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={start}-{end}",
+            IfMatch=self.etag,
         )
-        return res["Body"].read().decode("utf-8")
+        return res["Body"].read()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.first is not None:
+            data = self.first.read(len(b))
+            if data:
+                b[:len(data)] = data
+                return len(data)
+            self.first.close()
+            self.first = None
+        if not self.buffer:
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+            self.__submit()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            if self.first is not None:
+                self.first.close()
+                self.first = None
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            self.pending.clear()
+            self.buffer = memoryview(b"")
+        super().close()
 
 
 class Ssm(AwsResource):
@@ -62,11 +163,23 @@ class Ssm(AwsResource):
 class Dynamodb(AwsResource):
     def __init__(self, profile: str = None):
         super().__init__(profile)
-        self.resource = self.session.resource("dynamodb")
+        # resource はスレッドセーフではないため、レコード間で共有できる client を使う
+        self.client = self.session.client("dynamodb")
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
 
     def get_item(self, table_name: str, key: str) -> dict:
-        table = self.resource.Table(table_name)
-        return table.get_item(Key=key)["Item"]
+        item = self.client.get_item(
+            TableName=table_name,
+            Key={k: self.serializer.serialize(v) for k, v in key.items()},
+        )["Item"]
+        return {k: self.deserializer.deserialize(v) for k, v in item.items()}
+
+
+# (table_name, video_id) -> (master が指す current_version, 有効期限)
+# master の切り替え後も古いバージョンの項目は残るため、MASTER_CACHE_TTL 秒で取り直す
+MASTER_CACHE_TTL = 60.0
+_MASTER_CACHE: dict[tuple[str, str], tuple[str, float]] = {}
 
 
 class NotifyControllerTable(NamedTuple):
@@ -77,8 +190,17 @@ class NotifyControllerTable(NamedTuple):
     title: str
 
     @classmethod
-    def of(cls, table_name: str, video_id: str, profile: str = None) -> NotifyControllerTable:
-        dynamodb = Dynamodb(profile=profile)
+    def of(cls, dynamodb: Dynamodb, table_name: str, video_id: str) -> NotifyControllerTable:
+        cache_key = (table_name, video_id)
+        version, expires_at = _MASTER_CACHE.get(cache_key, (None, 0.0))
+        if version is not None and time.monotonic() < expires_at:
+            try:
+                return NotifyControllerTable(**dynamodb.get_item(table_name=table_name, key={"video_id": video_id, "version": version}))
+            except KeyError:
+                # キャッシュしたバージョンが存在しなければ master から取り直す
+                _MASTER_CACHE.pop(cache_key, None)
         master = dynamodb.get_item(table_name=table_name, key={
                                    "video_id": video_id, "version": "master"})
+        _MASTER_CACHE[cache_key] = (
+            master["current_version"], time.monotonic() + MASTER_CACHE_TTL)
         return NotifyControllerTable(**dynamodb.get_item(table_name=table_name, key={"video_id": video_id, "version": master["current_version"]}))
@@ -1,12 +1,18 @@
 from __future__ import annotations
 import logging
 
+import io
 import re
 import csv
-import datetime
+import functools
+import heapq
+from contextlib import closing, nullcontext
+from operator import attrgetter
 from pathlib import Path
-from typing import NamedTuple
+from typing import IO, Iterable, NamedTuple
 
+import numpy as np
+import pandas as pd
 import requests
 
 from aws_resource import S3, NotifyControllerTable
@@ -14,6 +20,13 @@ from aws_resource import S3, NotifyControllerTable
 
 logger = logging.getLogger(__name__)
 
+_DEFAULT_KUSA_RE = re.compile(r"草|w|くさ|kusa")
+
+# googleapis.com への接続を使い回す
+_YT_SESSION = requests.Session()
+# 配信終了後の liveStreamingDetails は変わらないので video_id ごとに保持する
+_LIVE_DETAILS_CACHE: dict[str, LiveStreamingDetails] = {}
+
 
 class ChatItem(NamedTuple):
     # メタ情報
@@ -59,16 +72,26 @@ class ChatItem(NamedTuple):
     ban_display_name: str  # banされたユーザーのチャンネル表示名
 
 
-def read_csv(file: Path) -> list[ChatItem]:
-    with file.open("r", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        result = []
-        for x in list(reader)[1:]:
-            try:
-                result.append(ChatItem(*x))
-            except TypeError as e:
-                logger.exception(f"len({len(x)}), {x}")
-        return result
+def read_csv(file: Path | IO[bytes], meta_type: str = "textMessageEvent") -> pd.DataFrame:
+    # 列数が合わない行はログに出して読み飛ばす
+    # 全行を保持しないよう、meta_type が一致する行の必要な列だけ残す
+    # (pandas.read_csv は列数の多い行を切り詰め、少ない行を空文字で埋めてしまう)
+    with (file.open("rb") if isinstance(file, Path) else nullcontext(file)) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+        next(reader, None)  # ヘッダー
+        published_at = []
+        message_text = []
+        for row in reader:
+            if len(row) != len(ChatItem._fields):
+                logger.warning(f"len({len(row)}), {row}")
+                continue
+            if row[0] == meta_type:
+                published_at.append(row[1])
+                message_text.append(row[2])
+    return pd.DataFrame({
+        "meta_publishedat": pd.Series(published_at, dtype=object),
+        "message_text": pd.Series(message_text, dtype=object),
+    })
 
 
 class S3Param(NamedTuple):
@@ -77,47 +100,31 @@ class S3Param(NamedTuple):
     s3: S3
 
 
-def read_s3_file(param: S3Param) -> list[ChatItem]:
-    file_path = f"/tmp/{param.key.split('/')[-1]}"
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(param.s3.read_file(bucket=param.bucket, key=param.key))
-    return read_csv(Path.cwd() / file_path)
+def read_s3_file(param: S3Param) -> pd.DataFrame:
+    # /tmp を経由せずレスポンスのストリームから直接読み込む
+    with closing(param.s3.read_file(bucket=param.bucket, key=param.key)) as body:
+        return read_csv(body)
 
 
+@functools.lru_cache(maxsize=65536)
 def format_secods(t: str) -> str:
     # 秒は6桁に統一
     # 2022-07-04T12:05:08.17237+00:00 -> 2022-07-04T12:05:08.172370+00:00
-    split_all = t.split("+")
-    split_date = split_all[0].split(".")
-    seconds = split_date[-1] + "0"*(6-len(split_date[-1]))
-    return f"{split_date[0]}.{seconds}+{split_all[-1]}"
-
-
-def format_timezone(t: str) -> str:
-    # 2022-07-13T13:03:06Z -> 2022-07-13T13:03:06+00:00
-    return f"{t[:-1]}+00:00"
-
-
-def to_unixtime(meta_publishedat: str) -> float:
-    # 2022-07-04T12:05:08.172370+00:00 -> 1656903908
-    return datetime.datetime.fromisoformat(meta_publishedat).timestamp()
-
-
-def timestamp(start: str, target: str) -> str:
-    start_time = datetime.datetime.fromisoformat(start)
-    target_time = datetime.datetime.fromisoformat(target)
-    diff_time = target_time - start_time
+    date_time, _, tz = t.partition("+")
+    base, _, seconds = date_time.partition(".")
+    return f"{base}.{seconds.ljust(6, '0')}+{tz}"
 
-    diff_sec = diff_time.total_seconds()
-    hh = int(diff_sec // 3600)
-    remain_sec = diff_sec - (hh * 3600)
-    mm = int(remain_sec // 60)
-    ss = int(remain_sec - (mm * 60))
 
-    if hh == 0:
-        return f"{mm:02}:{ss:02}"
-    else:
-        return f"{hh}:{mm:02}:{ss:02}"
+def timestamp(diff_sec: np.ndarray) -> np.ndarray:
+    # 経過秒(整数)の配列をまとめて変換する
+    # [3725, 65] -> ["1:02:05", "01:05"]
+    if diff_sec.size == 0:
+        # numpy 1.x の np.char.mod は空配列に対して文字列型の配列を返さない
+        return np.array([], dtype=str)
+    hh, remain_sec = np.divmod(diff_sec, 3600)
+    mm, ss = np.divmod(remain_sec, 60)
+    mm_ss = np.char.add(np.char.mod("%02d:", mm), np.char.mod("%02d", ss))
+    return np.where(hh == 0, mm_ss, np.char.add(np.char.mod("%d:", hh), mm_ss))
 
 
 class LiveStreamingDetails(NamedTuple):
@@ -127,6 +134,8 @@ class LiveStreamingDetails(NamedTuple):
 
     @classmethod
     def of(cls, api_key: str, video_id: str) -> LiveStreamingDetails:
+        if video_id in _LIVE_DETAILS_CACHE:
+            return _LIVE_DETAILS_CACHE[video_id]
         url = "https://www.googleapis.com/youtube/v3/videos"
         params = {
             "key": api_key,
@@ -134,10 +143,13 @@ class LiveStreamingDetails(NamedTuple):
             "part": "liveStreamingDetails",
             "maxResults": 50
         }
-        res = requests.get(url, params=params).json()
+        res = _YT_SESSION.get(url, params=params, timeout=5).json()
         if res.get("error"):
             raise Exception(f"videos api error: {res}")
-        return LiveStreamingDetails(**res["items"][0]["liveStreamingDetails"])
+        detail = LiveStreamingDetails(
+            **res["items"][0]["liveStreamingDetails"])
+        _LIVE_DETAILS_CACHE[video_id] = detail
+        return detail
 
 
 class MessageItem(NamedTuple):
@@ -146,76 +158,92 @@ class MessageItem(NamedTuple):
     unixtime: float
     message: str
 
-    @classmethod
-    def of(cls, item: ChatItem, start: str) -> MessageItem:
-        start_time = format_timezone(start)
-        target_time = format_secods(item.meta_publishedat)
-        return MessageItem(
-            timestamp=timestamp(start=start_time, target=target_time),
-            message=item.message_text,
-            date_time=target_time,
-            unixtime=to_unixtime(target_time),
-        )
 
-    def has_kusa(self, pattern) -> bool:
-        return re.search(pattern, self.message)
+def to_csv_lines(items: Iterable[MessageItem]) -> str:
+    # メッセージ中のカンマや改行はクォートして出力する
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(items)
+    return buf.getvalue().removesuffix("\n")
 
 
 class CsvFile(NamedTuple):
-    records: list[MessageItem]
+    # MessageItem の各項目を列ごとの配列で保持する
+    timestamps: np.ndarray
+    date_times: np.ndarray
+    unixtimes: np.ndarray
+    messages: np.ndarray
 
     @classmethod
     def of(cls, yt_api_kye: str, video_id: str, s3_param: S3Param) -> CsvFile:
         live_detail = LiveStreamingDetails.of(
             api_key=yt_api_kye, video_id=video_id)
-        records_raw = [
-            record for record in read_s3_file(s3_param) if record.meta_type == "textMessageEvent"]
-        result = [MessageItem.of(item=x, start=live_detail.actualStartTime)
-                  for x in records_raw]
-        return CsvFile(sorted(result, key=lambda x: x.unixtime))
+        start = pd.Timestamp(live_detail.actualStartTime)
+        df = read_s3_file(s3_param)
+        published = pd.to_datetime(
+            df.meta_publishedat, utc=True, format="ISO8601", cache=True)
+        # datetime.timestamp() と同じくマイクロ秒単位の整数から算出する
+        unixtimes = ((published - pd.Timestamp(0, tz="UTC")) //
+                     pd.Timedelta(1, "us") / 10**6).to_numpy(dtype=np.float64)
+        order = np.argsort(unixtimes, kind="stable")
+        return CsvFile(
+            timestamps=timestamp(((published - start) // pd.Timedelta(1, "s"))
+                                 .to_numpy(dtype=np.int64))[order],
+            date_times=df.meta_publishedat.map(
+                format_secods).to_numpy()[order],
+            unixtimes=unixtimes[order],
+            messages=df.message_text.to_numpy()[order],
+        )
 
+    def item(self, index: int) -> MessageItem:
+        return MessageItem(
+            timestamp=self.timestamps[index],
+            date_time=self.date_times[index],
+            unixtime=float(self.unixtimes[index]),
+            message=self.messages[index],
+        )
 
-class KusaDistanceBase(NamedTuple):
-    item: MessageItem
-    distance: int
+
+def kusa_mask(messages: np.ndarray, pattern: re.Pattern) -> np.ndarray:
+    return np.fromiter((pattern.search(message) is not None for message in messages),
+                       dtype=bool, count=len(messages))
 
 
 class KusaDistance(NamedTuple):
-    records: list[KusaDistanceBase]
+    csv: CsvFile
+    indices: np.ndarray  # 草を含むメッセージの csv 上の位置
+    distances: np.ndarray  # 直前の草メッセージとの間隔(秒)
     avarage: float
 
     @classmethod
-    def of(cls, csv: CsvFile, pattern: str = r"草|w|くさ|kusa") -> KusaDistance:
-        sum_distance = 0.0
-        before = csv.records[0].unixtime
-        index_distance: list[KusaDistanceBase] = []
-        for record in csv.records:
-            if not record.has_kusa(pattern):
-                continue
-            distance = record.unixtime - before
-            index_distance.append(KusaDistanceBase(
-                item=record, distance=distance))
-            before = record.unixtime
-            sum_distance += distance
+    def of(cls, csv: CsvFile, pattern: str | re.Pattern = _DEFAULT_KUSA_RE) -> KusaDistance:
+        compiled = pattern if isinstance(
+            pattern, re.Pattern) else re.compile(pattern)
+        indices = np.flatnonzero(kusa_mask(csv.messages, compiled))
+        if indices.size == 0:
+            raise ValueError(
+                f"no messages match pattern: {compiled.pattern}")
+        # 最初の草メッセージは先頭メッセージからの間隔とする
+        distances = np.diff(csv.unixtimes[indices], prepend=csv.unixtimes[0])
         return KusaDistance(
-            records=index_distance,
-            avarage=sum_distance / len(index_distance),
+            csv=csv,
+            indices=indices,
+            distances=distances,
+            avarage=float(distances.mean()),
         )
 
 
 class KusaGroup(NamedTuple):
-    groups: list[list[KusaDistanceBase]]
+    csv: CsvFile
+    groups: list[np.ndarray]
 
     @classmethod
     def of(cls, kusa_distance: KusaDistance) -> KusaGroup:
-        groups: list[list[KusaDistanceBase]] = []
-        temp = []
-        for record in kusa_distance.records:
-            temp.append(record)
-            if record.distance > kusa_distance.avarage:
-                groups.append([x for x in temp])
-                temp.clear()
-        return KusaGroup(groups=groups)
+        # 平均より間隔が空いたメッセージまでを 1 グループとする
+        # 最後の区切り以降のメッセージはグループに含めない
+        boundaries = np.flatnonzero(
+            kusa_distance.distances > kusa_distance.avarage) + 1
+        groups = np.split(kusa_distance.indices, boundaries)[:-1]
+        return KusaGroup(csv=kusa_distance.csv, groups=groups)
 
 
 class LogRecord(NamedTuple):
@@ -226,22 +254,20 @@ class LogRecord(NamedTuple):
     record: str
 
     @classmethod
-    def of(cls, n_index: int, group: list[KusaDistanceBase]) -> LogRecord:
+    def of(cls, n_index: int, csv: CsvFile, group: np.ndarray) -> LogRecord:
         return LogRecord(
             index=str(n_index).zfill(3),
             n_record=str(len(group)).zfill(4),
-            start_timestamp=group[0].item.timestamp,
-            end_timestamp=group[-1].item.timestamp,
-            record="\n".join(",".join(str(x) for x in record.item)
-                             for record in group)
+            start_timestamp=csv.timestamps[group[0]],
+            end_timestamp=csv.timestamps[group[-1]],
+            record=to_csv_lines(csv.item(index) for index in group)
         )
 
     def full_report(self) -> str:
-        result = f"[index: {self.index} len: {self.n_record}]" + "\n"
-        result += f"{self.start_timestamp} ~ {self.end_timestamp}" + "\n"
-        result += self.record + "\n"
-        result += "-"*10 + "\n"
-        return result
+        return (f"[index: {self.index} len: {self.n_record}]\n"
+                f"{self.start_timestamp} ~ {self.end_timestamp}\n"
+                f"{self.record}\n"
+                f"{'-'*10}\n")
 
     def report(self) -> str:
         return f"★ [{self.start_timestamp}]: {self.n_record} comments!\n"
@@ -255,14 +281,13 @@ class LogReport(NamedTuple):
         idx = 1
         log_records = []
         for group in item.groups:
-            log_records.append(LogRecord.of(n_index=idx, group=group))
+            log_records.append(LogRecord.of(
+                n_index=idx, csv=item.csv, group=group))
             idx += 1
         return LogReport(records=log_records)
 
     def create_md(self, table: NotifyControllerTable, n_target: int = 5) -> str:
-        target = sorted(self.records, key=lambda x: x.n_record,
-                        reverse=True)[:n_target]
-        result = f"{table.title}\n"
-        result += "".join(record.report()
-                          for record in sorted(target, key=lambda x: x.index))
-        return result
+        target = heapq.nlargest(
+            n_target, self.records, key=attrgetter("n_record"))
+        target.sort(key=attrgetter("index"))
+        return "".join([f"{table.title}\n", *map(LogRecord.report, target)])
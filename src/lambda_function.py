@@ -3,22 +3,34 @@ import json
 
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, NamedTuple
 
-from aws_resource import S3, Ssm, Sns, NotifyControllerTable
+from aws_resource import S3, Dynamodb, Ssm, Sns, NotifyControllerTable
 from convert import CsvFile, KusaDistance, KusaGroup, LogReport, S3Param
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
+# ウォームスタート時は SSM を再取得しない (パラメータ名 -> 値)
+_SECRETS_CACHE: dict[str, str] = {}
+
+# CSV の読み込みと集計はメモリを大きく使うため、同時に実行するのは 1 レコードまでとする
+# (256 MB の Lambda では 100 MB の CSV 1 件で 190 MB 程度になる)
+_PARSE_SEMAPHORE = threading.BoundedSemaphore(1)
+
 
 class SecretParams(NamedTuple):
     YOUTUBE_API_KEY: str
 
     @classmethod
     def of(cls, ssm: Ssm) -> SecretParams:
-        return SecretParams(**{x: ssm.value(os.environ[x]) for x in SecretParams._fields})
+        for x in SecretParams._fields:
+            if os.environ[x] not in _SECRETS_CACHE:
+                _SECRETS_CACHE[os.environ[x]] = ssm.value(os.environ[x])
+        return SecretParams(**{x: _SECRETS_CACHE[os.environ[x]] for x in SecretParams._fields})
 
 
 class EnvironParams(NamedTuple):
@@ -60,6 +72,7 @@ class LambdaService(NamedTuple):
     ssm: Ssm
     s3: S3
     sns: Sns
+    dynamodb: Dynamodb
     profile: str | None
 
     @classmethod
@@ -68,6 +81,7 @@ class LambdaService(NamedTuple):
         ssm = Ssm(profile=profile)
         s3 = S3(profile=profile)
         sns = Sns(profile=profile)
+        dynamodb = Dynamodb(profile=profile)
         return LambdaService(
             env_param=EnvironParams.of(),
             ssm_param=SecretParams.of(ssm),
@@ -75,41 +89,66 @@ class LambdaService(NamedTuple):
             ssm=ssm,
             s3=s3,
             sns=sns,
+            dynamodb=dynamodb,
             profile=profile,
         )
 
+    def __create_report(self, record: S3Event) -> LogReport:
+        s3_param = S3Param(
+            bucket=self.env_param.SOURCE_S3_BUCKET,
+            # {channel_id}/{video_id}.png -> {channel_id}/{video_id}.csv
+            key=f"{record.key.split('.')[0]}.csv",
+            s3=self.s3
+        )
+        csv = CsvFile.of(
+            yt_api_kye=self.ssm_param.YOUTUBE_API_KEY,
+            video_id=record.video_id,
+            s3_param=s3_param,
+        )
+        kusa_distance = KusaDistance.of(
+            csv=csv,
+            pattern=self.env_param.PATTERN,
+        )
+        kusa_group = KusaGroup.of(kusa_distance=kusa_distance)
+        return LogReport.of(item=kusa_group)
+
+    def __process(self, record: S3Event) -> None:
+        logger.info(f"[start]\n{json.dumps(record, indent=2)}")
+        table = NotifyControllerTable.of(
+            dynamodb=self.dynamodb,
+            table_name=self.env_param.NOTIFY_CONTROLLER_TABLE_NAME,
+            video_id=record.video_id,
+        )
+        # CsvFile は __create_report を抜けた時点で解放される
+        with _PARSE_SEMAPHORE:
+            log_report = self.__create_report(record)
+        output_md = log_report.create_md(table)
+        logger.info(f"[s3 upload]\n{output_md}")
+        self.s3.upload(
+            data=output_md.encode("utf-8"),
+            bucket_name=self.env_param.OUTPUT_S3_BUCKET,
+            file_path=f"{record.channel_id}/{record.video_id}.md"
+        )
+
+    def __try_process(self, record: S3Event) -> Exception | None:
+        try:
+            self.__process(record)
+        except Exception as e:
+            logger.exception(f"[failed] {record.key}")
+            return e
+        return None
+
     def __service(self) -> None:
-        for record in self.s3_reocrds:
-            logger.info(f"[start]\n{json.dumps(record, indent=2)}")
-            s3_param = S3Param(
-                bucket=self.env_param.SOURCE_S3_BUCKET,
-                # {channel_id}/{video_id}.png -> {channel_id}/{video_id}.csv
-                key=f"{record.key.split('.')[0]}.csv",
-                s3=self.s3
-            )
-            csv = CsvFile.of(
-                yt_api_kye=self.ssm_param.YOUTUBE_API_KEY,
-                video_id=record.video_id,
-                s3_param=s3_param,
-            )
-            kusa_distance = KusaDistance.of(
-                csv=csv,
-                pattern=self.env_param.PATTERN,
-            )
-            table = NotifyControllerTable.of(
-                table_name=self.env_param.NOTIFY_CONTROLLER_TABLE_NAME,
-                video_id=record.video_id,
-                profile=self.profile,
-            )
-            kusa_group = KusaGroup.of(kusa_distance=kusa_distance)
-            log_report = LogReport.of(item=kusa_group)
-            output_md = log_report.create_md(table)
-            logger.info(f"[s3 upload]\n{output_md}")
-            self.s3.upload(
-                data=output_md.encode("utf-8"),
-                bucket_name=self.env_param.OUTPUT_S3_BUCKET,
-                file_path=f"{record.channel_id}/{record.video_id}.md"
-            )
+        if not self.s3_reocrds:
+            return
+        # レコードごとの処理は I/O 待ちが大半なのでスレッドで並列に実行する
+        # エラーは全レコードの処理後にまとめて通知する
+        with ThreadPoolExecutor(max_workers=min(16, len(self.s3_reocrds))) as executor:
+            results = list(executor.map(self.__try_process, self.s3_reocrds))
+        errors = [f"{record.key}: {e}"
+                  for record, e in zip(self.s3_reocrds, results) if e is not None]
+        if errors:
+            raise Exception("\n".join(errors))
 
     def __call__(self) -> None:
         return self.__service()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Lambda と同じく src 直下のモジュールをトップレベルで import する
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
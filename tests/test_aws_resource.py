@@ -0,0 +1,160 @@
+import io
+import random
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import aws_resource
+from aws_resource import S3, Dynamodb, NotifyControllerTable
+
+
+class FakeDynamodbClient:
+    def __init__(self, items: dict):
+        self.items = items
+        self.requests = []
+
+    def get_item(self, TableName: str, Key: dict) -> dict:
+        self.requests.append((TableName, Key))
+        item = self.items.get((Key["video_id"]["S"], Key["version"]["S"]))
+        return {} if item is None else {"Item": item}
+
+
+@pytest.fixture
+def dynamodb(monkeypatch) -> Dynamodb:
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-northeast-1")
+    return Dynamodb()
+
+
+def test_dynamodb_get_item_deserializes(dynamodb):
+    dynamodb.client = FakeDynamodbClient({
+        ("v", "master"): {"video_id": {"S": "v"}, "version": {"S": "master"},
+                          "current_version": {"S": "1"}, "n": {"N": "3"}},
+    })
+    item = dynamodb.get_item(table_name="t", key={
+                             "video_id": "v", "version": "master"})
+    assert item == {"video_id": "v", "version": "master",
+                    "current_version": "1", "n": 3}
+    assert dynamodb.client.requests == [
+        ("t", {"video_id": {"S": "v"}, "version": {"S": "master"}})]
+
+
+def test_dynamodb_get_item_missing(dynamodb):
+    dynamodb.client = FakeDynamodbClient({})
+    with pytest.raises(KeyError):
+        dynamodb.get_item(table_name="t", key={
+                          "video_id": "v", "version": "master"})
+
+
+def versioned_item(version: str, title: str) -> dict:
+    return {"video_id": {"S": "v"}, "version": {"S": version},
+            "scheduled_start_time": {"S": "s"}, "time_stamp": {"S": "t"},
+            "title": {"S": title}}
+
+
+def test_notify_controller_table_master_cache(dynamodb, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(aws_resource.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(aws_resource, "_MASTER_CACHE", {})
+    items = {
+        ("v", "master"): {"video_id": {"S": "v"}, "version": {"S": "master"},
+                          "current_version": {"S": "1"}},
+        ("v", "1"): versioned_item("1", "old"),
+    }
+    dynamodb.client = FakeDynamodbClient(items)
+
+    def versions() -> list[str]:
+        return [key["version"]["S"] for _, key in dynamodb.client.requests]
+
+    def title() -> str:
+        return NotifyControllerTable.of(dynamodb=dynamodb, table_name="t", video_id="v").title
+
+    assert title() == "old"
+    assert title() == "old"
+    assert versions() == ["master", "1", "1"]
+
+    # master が切り替わっても古い項目は残る。TTL 内はキャッシュを使う
+    items[("v", "master")]["current_version"] = {"S": "2"}
+    items[("v", "2")] = versioned_item("2", "new")
+    now[0] += aws_resource.MASTER_CACHE_TTL - 1
+    assert title() == "old"
+    now[0] += 2
+    assert title() == "new"
+    assert versions() == ["master", "1", "1", "1", "master", "2"]
+
+    # キャッシュしたバージョンの項目が消えていれば master から取り直す
+    items[("v", "master")]["current_version"] = {"S": "3"}
+    items[("v", "3")] = versioned_item("3", "newer")
+    del items[("v", "2")]
+    assert title() == "newer"
+    assert versions()[-3:] == ["2", "master", "3"]
+
+
+class FakeS3Client:
+    # Range / ContentRange / IfMatch を S3 と同じように扱う
+    def __init__(self, data: bytes):
+        self.data = data
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, IfMatch: str = None) -> dict:
+        if IfMatch is not None:
+            assert IfMatch == "etag"
+        if Range is None:
+            return {"Body": io.BytesIO(self.data), "ETag": "etag"}
+        if not self.data:
+            raise ClientError(
+                {"Error": {"Code": "InvalidRange"}}, "GetObject")
+        with self.lock:
+            self.ranges.append(Range)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # 完了順がばらばらになるよう待つ
+        time.sleep(random.random() / 1000)
+        with self.lock:
+            self.in_flight -= 1
+        start, end = (int(x) for x in Range.removeprefix("bytes=").split("-"))
+        end = min(end, len(self.data) - 1)
+        return {
+            "Body": io.BytesIO(self.data[start:end + 1]),
+            "ContentRange": f"bytes {start}-{end}/{len(self.data)}",
+            "ETag": "etag",
+        }
+
+
+@pytest.fixture
+def s3(monkeypatch) -> S3:
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "ap-northeast-1")
+    monkeypatch.setattr(aws_resource, "RANGE_SIZE", 8)
+    return S3()
+
+
+@pytest.mark.parametrize("size, n_requests", [
+    (1, 1), (7, 1), (8, 1), (9, 2), (16, 2), (17, 3), (100, 13),
+])
+def test_s3_read_file_ranges(s3, size, n_requests):
+    data = bytes(random.randrange(256) for _ in range(size))
+    s3.client = FakeS3Client(data)
+    with s3.read_file(bucket="b", key="k") as f:
+        assert f.read() == data
+    assert len(s3.client.ranges) == n_requests
+    assert s3.client.ranges[0] == "bytes=0-7"
+    assert s3.client.max_in_flight <= aws_resource.MAX_RANGE_REQUESTS
+
+
+def test_s3_read_file_empty(s3):
+    s3.client = FakeS3Client(b"")
+    with s3.read_file(bucket="b", key="k") as f:
+        assert f.read() == b""
+
+
+def test_s3_read_file_close_early(s3):
+    s3.client = FakeS3Client(bytes(1000))
+    f = s3.read_file(bucket="b", key="k")
+    assert f.read(3) == bytes(3)
+    f.close()
+    # 先読みは MAX_RANGE_REQUESTS 個までで止まる
+    assert len(s3.client.ranges) <= 1 + aws_resource.MAX_RANGE_REQUESTS
@@ -0,0 +1,128 @@
+import csv
+import io
+
+import numpy as np
+import pytest
+from botocore.response import StreamingBody
+
+import convert
+from convert import ChatItem, CsvFile, KusaDistance, KusaGroup, LiveStreamingDetails, S3Param, read_csv
+
+
+def to_csv(rows: list[list[str]]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(ChatItem._fields)
+    writer.writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+
+def chat_row(published_at: str, message: str, meta_type: str = "textMessageEvent") -> list[str]:
+    return [meta_type, published_at, message] + [""] * (len(ChatItem._fields) - 3)
+
+
+GOOD = [
+    chat_row("2022-07-04T12:05:08.1+00:00", "草"),
+    chat_row("2022-07-04T12:05:09.2+00:00", "hello, world"),
+    chat_row("2022-07-04T12:05:10.3+00:00", "super", meta_type="superChatEvent"),
+    chat_row("2022-07-04T12:05:11.4+00:00", "www"),
+]
+# カンマがクォートされずに 1 列多くなった行と、列が足りない行
+LONG = chat_row("2022-07-04T12:06:00+00:00", "foo") + ["bar"]
+SHORT = chat_row("2022-07-04T12:06:01+00:00", "short")[:-1]
+
+
+@pytest.mark.parametrize("rows", [
+    [LONG, SHORT] + GOOD,
+    GOOD[:2] + [LONG, SHORT] + GOOD[2:],
+], ids=["first", "middle"])
+def test_read_csv_skips_malformed_rows(rows, caplog):
+    df = read_csv(io.BytesIO(to_csv(rows)))
+    assert df.to_dict("records") == [
+        {"meta_publishedat": "2022-07-04T12:05:08.1+00:00", "message_text": "草"},
+        {"meta_publishedat": "2022-07-04T12:05:09.2+00:00",
+         "message_text": "hello, world"},
+        {"meta_publishedat": "2022-07-04T12:05:11.4+00:00", "message_text": "www"},
+    ]
+    assert len([r for r in caplog.records if r.levelname == "WARNING"]) == 2
+
+
+def test_read_csv_streaming_body():
+    data = to_csv(GOOD)
+    df = read_csv(StreamingBody(io.BytesIO(data), len(data)))
+    assert df.message_text.tolist() == ["草", "hello, world", "www"]
+
+
+def test_read_csv_header_only():
+    df = read_csv(io.BytesIO(to_csv([])))
+    assert df.empty
+    assert list(df.columns) == ["meta_publishedat", "message_text"]
+
+
+def csv_file(unixtimes: list[float], messages: list[str]) -> CsvFile:
+    return CsvFile(
+        timestamps=np.array([f"00:{int(x):02}" for x in unixtimes]),
+        date_times=np.array([""] * len(unixtimes)),
+        unixtimes=np.array(unixtimes, dtype=np.float64),
+        messages=np.array(messages, dtype=object),
+    )
+
+
+def test_kusa_distance_and_group():
+    csv = csv_file([0, 1, 2, 10, 11, 30, 31],
+                   ["a", "草", "w", "草", "b", "kusa", "草"])
+    kusa_distance = KusaDistance.of(csv=csv)
+    assert kusa_distance.indices.tolist() == [1, 2, 3, 5, 6]
+    assert kusa_distance.distances.tolist() == [1, 1, 8, 20, 1]
+    assert kusa_distance.avarage == pytest.approx(6.2)
+    # 最後の区切り以降は含めない
+    groups = KusaGroup.of(kusa_distance=kusa_distance).groups
+    assert [x.tolist() for x in groups] == [[1, 2, 3], [5]]
+
+
+def test_kusa_distance_without_match():
+    csv = csv_file([0, 1], ["a", "b"])
+    with pytest.raises(ValueError, match="no messages match"):
+        KusaDistance.of(csv=csv)
+
+
+class FakeS3:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read_file(self, bucket: str, key: str) -> io.BytesIO:
+        return io.BytesIO(self.data)
+
+
+@pytest.fixture
+def live_detail(monkeypatch):
+    monkeypatch.setattr(convert, "_LIVE_DETAILS_CACHE", {
+        "v": LiveStreamingDetails(
+            actualStartTime="2022-07-04T12:05:00Z",
+            actualEndTime="2022-07-04T13:05:00Z",
+            scheduledStartTime="2022-07-04T12:00:00Z",
+        ),
+    })
+
+
+def csv_file_of(rows: list[list[str]]) -> CsvFile:
+    return CsvFile.of(yt_api_kye="key", video_id="v", s3_param=S3Param(
+        bucket="b", key="c/v.csv", s3=FakeS3(to_csv(rows))))
+
+
+def test_csv_file_of(live_detail):
+    csv = csv_file_of(GOOD)
+    assert csv.timestamps.tolist() == ["00:08", "00:09", "00:11"]
+    assert csv.messages.tolist() == ["草", "hello, world", "www"]
+    assert KusaDistance.of(csv=csv).indices.tolist() == [0, 1, 2]
+
+
+@pytest.mark.parametrize("rows", [
+    [],
+    [chat_row("2022-07-04T12:05:08+00:00", "草", meta_type="superChatEvent")],
+], ids=["header_only", "no_text_message"])
+def test_csv_file_of_without_text_message(live_detail, rows):
+    csv = csv_file_of(rows)
+    assert csv.unixtimes.size == 0
+    with pytest.raises(ValueError, match="no messages match"):
+        KusaDistance.of(csv=csv)
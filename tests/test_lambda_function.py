@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+import lambda_function
+from lambda_function import LambdaService, S3Event
+
+
+class FakeReport:
+    def create_md(self, table) -> str:
+        return "md"
+
+
+class FakeS3:
+    def __init__(self):
+        self.uploaded = []
+
+    def upload(self, data: bytes, bucket_name: str, file_path: str) -> None:
+        self.uploaded.append(file_path)
+
+
+class FakeEnv:
+    NOTIFY_CONTROLLER_TABLE_NAME = "table"
+    OUTPUT_S3_BUCKET = "output"
+
+
+def test_service_parses_one_record_at_a_time(monkeypatch):
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def create_report(self, record):
+        with lock:
+            running.append(record)
+            max_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(record)
+        if record.video_id == "bad":
+            raise ValueError("boom")
+        return FakeReport()
+
+    monkeypatch.setattr(
+        LambdaService, "_LambdaService__create_report", create_report)
+    monkeypatch.setattr(lambda_function.NotifyControllerTable, "of",
+                        classmethod(lambda cls, **kwargs: None))
+    records = [S3Event(video_id=v, channel_id="c", bucket_name="b", key=f"c/{v}.png")
+               for v in ["a", "bad", "c", "d"]]
+    s3 = FakeS3()
+    service = LambdaService(env_param=FakeEnv(), ssm_param=None, s3_reocrds=records,
+                            ssm=None, s3=s3, sns=None, dynamodb=None, profile=None)
+
+    with pytest.raises(Exception, match="c/bad.png: boom"):
+        service()
+    assert max(max_running) == 1
+    assert sorted(s3.uploaded) == ["c/a.md", "c/c.md", "c/d.md"]